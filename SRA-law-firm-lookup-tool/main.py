@@ -1,16 +1,33 @@
 # main.py
+import asyncio
+import hashlib
+import logging
 import os
 import re
-from typing import List, Dict, Any
+import sys
+import time
+from functools import lru_cache
+from typing import List, Dict, Any, Iterable, NamedTuple, Optional, Tuple
+from urllib.parse import quote, urlencode
 
-import requests
+import diskcache
+import httpx
+import ijson
+import orjson
+import re2
+from redis import asyncio as redis_asyncio
+from redis.exceptions import RedisError
 from dotenv import load_dotenv
-from fastapi import FastAPI, HTTPException, Query
+from fastapi import FastAPI, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse
 
 # ---------- config / secrets ----------
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 SRA_API_KEY = os.getenv("SRA_API_KEY")
 
 # On Render, azure-api.net DNS can be flaky; try microsites first, then azure-api.
@@ -27,8 +44,45 @@ HEADERS = {
     "Cache-Control": "no-cache",
 }
 
+# How long a fetched Organisations payload is served from memory (seconds).
+ORG_CACHE_TTL = int(os.getenv("SRA_CACHE_TTL", "600"))
+# After a failed refresh, keep serving the stale copy this long before retrying.
+ORG_CACHE_RETRY = 30
+# On-disk copy of the index so restarts and sibling workers skip the download.
+SRA_DISK_CACHE_DIR = os.getenv("SRA_DISK_CACHE_DIR", "/tmp/sra-cache")
+# How long a persisted index (disk or Redis) is kept as a stale fallback.
+STALE_INDEX_TTL = 6 * 60 * 60
+# Optional: share one index across workers/instances (e.g. Render Key Value).
+REDIS_URL = os.getenv("REDIS_URL")
+# /search answers only change when the index does; let browsers/CDNs reuse them.
+SEARCH_CACHE_CONTROL = "public, max-age=60, stale-while-revalidate=300"
+
 # ---------- app ----------
-app = FastAPI(title="BriefBase SRA Finder", version="0.3.0")
+app = FastAPI(
+    title="BriefBase SRA Finder",
+    version="0.3.0",
+    default_response_class=ORJSONResponse,
+)
+
+# One pooled client for all upstream calls; opened/closed with the app.
+# Kept-alive HTTP/2 connections mean one TLS handshake to APIM is reused across
+# refreshes, probes and cold-start searches, which multiplex over it.
+client: Optional[httpx.AsyncClient] = None
+
+@app.on_event("startup")
+async def open_client():
+    global client
+    client = httpx.AsyncClient(
+        headers=HEADERS,
+        timeout=20,
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=10, keepalive_expiry=60),
+    )
+
+@app.on_event("shutdown")
+async def close_client():
+    if client is not None:
+        await client.aclose()
 
 # Open CORS during testing (tighten later to your domain)
 app.add_middleware(
@@ -39,9 +93,11 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Popular outward codes return tens of KB of repetitive JSON; gzip it
+app.add_middleware(GZipMiddleware, minimum_size=1024)
+
 # ---------- helpers ----------
-UK_PC_RE = re.compile(
-    r"""
+_UK_PC_PATTERN = r"""
     ^\s*
     (GIR\s?0AA|
      (?:[A-PR-UWYZ][0-9][0-9]?|
@@ -50,122 +106,597 @@ UK_PC_RE = re.compile(
         [A-PR-UWYZ][A-HK-Y][0-9][ABEHMNPRVWXY]?)
      \s?[0-9][ABD-HJLNP-UW-Z]{2})
     \s*$
-    """,
-    re.IGNORECASE | re.VERBOSE,
-)
+    """
+# RE2 matches in linear time with no backtracking; it takes no re flags, so the
+# layout whitespace is stripped (the pattern has no literal spaces) and the
+# case flag is inlined.
+UK_PC_RE = re2.compile("(?i)" + "".join(_UK_PC_PATTERN.split()))
 
+_WS_RE = re.compile(r"\s+")
+# Longest raw /search input worth normalising: "AA9A 9AA" plus stray whitespace
+MAX_POSTCODE_INPUT = 16
+
+# Both are memoised: index builds see the same postcodes over and over
+# (many offices per district), and users repeat popular searches.
+@lru_cache(maxsize=8192)
 def normalise_postcode(pc: str) -> str:
     pc = (pc or "").upper()
-    pc = re.sub(r"\s+", " ", pc).strip()
+    pc = _WS_RE.sub(" ", pc).strip()
     return pc
 
+def plausible_postcode(pc: str) -> bool:
+    """
+    Cheap shape check on a normalised postcode: 5-7 ASCII letters/digits once
+    spaces are dropped. Rejects most junk without starting the regex engine.
+    """
+    compact = pc.replace(" ", "")
+    return 5 <= len(compact) <= 7 and compact.isascii() and compact.isalnum()
+
+@lru_cache(maxsize=8192)
 def outward_code(pc: str) -> str:
     pc = normalise_postcode(pc)
     if " " in pc:
         return pc.split(" ", 1)[0]
     return pc[:-3] if len(pc) > 3 else pc
 
+@lru_cache(maxsize=8192)
+def full_postcode(pc: str) -> str:
+    """
+    Canonical "OUTWARD INWARD" form, so SW1A1AA and sw1a 1aa share an index key.
+    Empty for anything too short to have an inward part.
+    """
+    compact = normalise_postcode(pc).replace(" ", "")
+    return f"{compact[:-3]} {compact[-3:]}" if len(compact) > 3 else ""
+
+_ACTIVE_WORDS = ("authorised", "registered", "authorised body", "recognised body")
+# Exact-match fast path over the same keywords: a status that is exactly one of
+# them is settled by one set probe, without the substring scan
+_ACTIVE_STATUSES = frozenset(_ACTIVE_WORDS)
+
+@lru_cache(maxsize=256)
+def _status_mentions_active(status: str) -> bool:
+    # Memoised fallback for any other wording (e.g. with a suffix): the original
+    # substring check, run once per distinct status value.
+    return any(w in status for w in _ACTIVE_WORDS)
+
 def looks_active(org: Dict[str, Any]) -> bool:
     status = (org.get("AuthorisationStatus") or "").strip().lower()
-    return any(w in status for w in [
-        "authorised", "registered", "authorised body", "recognised body"
-    ])
-
-def office_matches_postcode(office: Dict[str, Any], target_pc: str) -> bool:
-    addrs = office.get("Address", {}) or {}
-    pc = addrs.get("PostCode") or ""
-    if not pc:
-        return False
-    return outward_code(pc) == outward_code(target_pc)
+    return status in _ACTIVE_STATUSES or _status_mentions_active(status)
+
+class Firm(NamedTuple):
+    """One /search result row. A tuple, not a dict, so the in-memory index stays small."""
+    OrganisationID: Any
+    Name: Optional[str]
+    Email: Optional[str]
+    Phone: Optional[str]
+    Postcode: Optional[str]
+    Address1: Optional[str]
+    Town: Optional[str]
+    AuthorisationStatus: Optional[str]
+
+def _shared(value: Any) -> Any:
+    # Interned so the thousands of repeats of a town/status/postcode share one str
+    return sys.intern(value) if isinstance(value, str) else value
+
+def firm_row(org: Dict[str, Any], addrs: Dict[str, Any]) -> Firm:
+    return Firm(
+        OrganisationID=org.get("OrganisationID"),
+        Name=org.get("OrganisationName"),
+        Email=org.get("Email") or org.get("GeneralEmail"),
+        Phone=org.get("Phone"),
+        Postcode=_shared(addrs.get("PostCode")),
+        Address1=addrs.get("Address1"),
+        Town=_shared(addrs.get("Town")),
+        AuthorisationStatus=_shared(org.get("AuthorisationStatus")),
+    )
 
-def call_sra_json(path: str, *, timeout: int = 20) -> Dict[str, Any]:
+def index_orgs(index: Dict[str, List[Firm]], orgs: Iterable[Dict[str, Any]]) -> None:
     """
-    Try each base host in order; return the first successful JSON.
+    Add organisations to the postcode -> result rows index. Each office is filed
+    under its outward code ("SW1A") and its full postcode ("SW1A 1AA"); the
+    space keeps the two kinds of key apart in one dict.
+    Only active orgs are indexed, and each org appears at most once per key
+    (its first office there), matching the old per-query scan.
+    """
+    # This runs for every office on every refresh: bind the hot names once
+    active = looks_active
+    outward_of = outward_code
+    full_of = full_postcode
+    row = firm_row
+    bucket = index.setdefault
+    for org in orgs:
+        if not active(org):
+            continue
+        seen = set()
+        for office in org.get("Offices") or ():
+            try:
+                addrs = office["Address"]
+                pc = addrs["PostCode"]
+            except (KeyError, TypeError):  # missing or null Address
+                continue
+            if not pc:
+                continue
+            firm = None
+            for key in (outward_of(pc), full_of(pc)):
+                if not key or key in seen:
+                    continue
+                seen.add(key)
+                if firm is None:
+                    firm = row(org, addrs)  # one row shared by both keys
+                bucket(key, []).append(firm)
+
+async def fetch_sra(
+    path: str,
+    *,
+    timeout: int = 20,
+    headers: Optional[Dict[str, str]] = None,
+    stream: bool = False,
+    final_statuses: Iterable[int] = (),
+) -> httpx.Response:
+    """
+    Try each base host in order; return the first successful response.
+    A 304 Not Modified counts as success (for conditional requests), as does any
+    status in final_statuses: ones the next host would answer the same way.
+    With stream=True the body is left unread and the caller must aclose() it.
     If all fail, surface the last error.
     """
     last_error = None
     for base in SRA_HOSTS:
         url = f"{base.rstrip('/')}/{path.lstrip('/')}"
         try:
-            resp = requests.get(url, headers=HEADERS, timeout=timeout)
+            req = client.build_request("GET", url, headers=headers, timeout=timeout)
+            resp = await client.send(req, stream=stream)
+            if resp.is_success or resp.status_code == 304 or resp.status_code in final_statuses:
+                return resp
+            await resp.aread()  # load (and release) the error body for the detail below
             resp.raise_for_status()
-            return resp.json()
-        except requests.exceptions.HTTPError as e:
+        except httpx.HTTPStatusError as e:
             # HTTP error with a response (e.g., 401/403/5xx)
-            try:
-                detail = resp.text[:500]  # type: ignore
-            except Exception:
-                detail = str(e)
+            detail = e.response.text[:500] or str(e)
             last_error = f"HTTPError on {base}: {detail}"
-        except requests.exceptions.SSLError as e:
-            last_error = f"SSLError on {base}: {e}"
-        except requests.exceptions.RequestException as e:
+        except httpx.RequestError as e:
+            # DNS / connect / TLS / timeout failures
             last_error = f"Network error on {base}: {e}"
         # Try next base
     raise HTTPException(status_code=502, detail=f"SRA API network error: {last_error}")
 
+# ---------- organisations cache ----------
+_ORG_CACHE: Dict[str, Any] = {
+    "index": None,
+    "expires": 0.0,
+    # Validators from the last full download, replayed as a conditional GET
+    "etag": None,
+    "last_modified": None,
+    # Wall-clock time of the last successful fetch/revalidation (comparable across processes)
+    "fetched_at": 0.0,
+    # Changes whenever the index content does (not on a 304); feeds /search ETags
+    "generation": None,
+}
+_ORG_CACHE_LOCK = asyncio.Lock()
+
+# Only used in in-memory mode; with REDIS_URL set the shared index replaces it
+_DISK_CACHE: Optional[diskcache.Cache] = None if REDIS_URL else diskcache.Cache(SRA_DISK_CACHE_DIR)
+# The index and its bookkeeping live under separate keys, so checking freshness
+# (every TTL expiry) and recording a 304 never unpickle or rewrite the index.
+_DISK_KEY = "Organisations:v3"  # (generation, index); bump when the index layout changes
+_DISK_META_KEY = f"{_DISK_KEY}:meta"
+_DISK_META_FIELDS = ("etag", "last_modified", "fetched_at", "generation")
+
+def _adopt_meta(meta: Dict[str, Any]) -> None:
+    # Keep whatever is left of its TTL (a stale copy is still a fallback)
+    _ORG_CACHE.update(meta)
+    age = time.time() - meta["fetched_at"]
+    _ORG_CACHE["expires"] = time.monotonic() + max(0.0, ORG_CACHE_TTL - age)
+
+async def load_disk_cache() -> None:
+    """
+    Adopt the on-disk copy if it is newer than what we hold in memory. The index
+    itself is only loaded when its generation differs from ours.
+    """
+    meta = await asyncio.to_thread(_DISK_CACHE.get, _DISK_META_KEY)
+    if meta is None or meta["fetched_at"] <= _ORG_CACHE["fetched_at"]:
+        return
+    if _ORG_CACHE["index"] is not None and meta["generation"] == _ORG_CACHE["generation"]:
+        _adopt_meta(meta)  # same content, just revalidated more recently
+        return
+    entry = await asyncio.to_thread(_DISK_CACHE.get, _DISK_KEY)
+    if entry is None or entry[0] != meta["generation"]:
+        return  # index and meta from different writes; try again next expiry
+    _ORG_CACHE["index"] = entry[1]
+    _adopt_meta(meta)
+
+async def save_disk_cache(index_changed: bool) -> None:
+    meta = {k: _ORG_CACHE[k] for k in _DISK_META_FIELDS}
+
+    def write() -> None:
+        if index_changed:
+            entry = (_ORG_CACHE["generation"], _ORG_CACHE["index"])
+            _DISK_CACHE.set(_DISK_KEY, entry, expire=STALE_INDEX_TTL)
+        else:
+            _DISK_CACHE.touch(_DISK_KEY, expire=STALE_INDEX_TTL)
+        # Meta last, so readers never see it ahead of the index it describes
+        _DISK_CACHE.set(_DISK_META_KEY, meta, expire=STALE_INDEX_TTL)
+
+    await asyncio.to_thread(write)
+
+async def stream_firm_index(resp: httpx.Response) -> Dict[str, List[Firm]]:
+    """
+    Build the index straight off the wire: ijson yields one network
+    chunk's worth of organisations at a time from the streamed body, so peak
+    memory is the index plus a few orgs rather than the raw bytes plus the
+    fully parsed payload.
+    """
+    index: Dict[str, List[Firm]] = {}
+    orgs = ijson.sendable_list()
+    parser = ijson.items_coro(orgs, "value.item", use_float=True)
+    async for chunk in resp.aiter_bytes():
+        parser.send(chunk)
+        index_orgs(index, orgs)
+        del orgs[:]
+    parser.close()
+    index_orgs(index, orgs)
+    return index
+
+async def download_firm_index(
+    etag: Optional[str], last_modified: Optional[str]
+) -> Optional[Tuple[Dict[str, List[Firm]], Optional[str], Optional[str]]]:
+    """
+    Conditional GET of Organisations, streamed into a fresh index.
+    Passing the validators of the copy we hold means an unchanged dataset costs
+    a header-only 304 (returned as None) instead of a multi-MB download;
+    otherwise returns (index, etag, last_modified).
+    """
+    conditional: Dict[str, str] = {}
+    if etag:
+        conditional["If-None-Match"] = etag
+    if last_modified:
+        conditional["If-Modified-Since"] = last_modified
+
+    resp = await fetch_sra("Organisations", headers=conditional, stream=True)
+    try:
+        if resp.status_code == 304:
+            return None
+        # The payload includes Offices, so the whole index comes from this one call
+        index = await stream_firm_index(resp)
+        return index, resp.headers.get("ETag"), resp.headers.get("Last-Modified")
+    except (httpx.RequestError, ijson.JSONError) as e:
+        # Cut off or garbled mid-body: keep the old index, let the caller fall back
+        raise HTTPException(status_code=502, detail=f"SRA API stream error: {e}")
+    finally:
+        await resp.aclose()
+
+async def refresh_firm_index() -> None:
+    """
+    Revalidate Organisations upstream and rebuild the in-memory index if it changed.
+    """
+    if _ORG_CACHE["index"] is None:
+        fresh = await download_firm_index(None, None)
+    else:
+        fresh = await download_firm_index(_ORG_CACHE["etag"], _ORG_CACHE["last_modified"])
+    now = time.time()
+    if fresh is not None:
+        _ORG_CACHE["index"], _ORG_CACHE["etag"], _ORG_CACHE["last_modified"] = fresh
+        _ORG_CACHE["generation"] = str(now)
+    _ORG_CACHE["fetched_at"] = now
+    _ORG_CACHE["expires"] = time.monotonic() + ORG_CACHE_TTL
+    # After a 304 only the small meta entry is rewritten
+    await save_disk_cache(index_changed=fresh is not None)
+
+async def get_firm_index() -> Dict[str, List[Firm]]:
+    """
+    Return the postcode index, refreshing it from Organisations at most once per TTL.
+    Only one task refreshes at a time; the rest wait and reuse its result.
+    If the refresh fails but we still hold an older index (in memory or on disk),
+    serve that instead of a 502.
+    """
+    if time.monotonic() < _ORG_CACHE["expires"]:
+        return _ORG_CACHE["index"]
+    async with _ORG_CACHE_LOCK:
+        # Someone else may have refreshed while we waited for the lock
+        if time.monotonic() < _ORG_CACHE["expires"]:
+            return _ORG_CACHE["index"]
+        # ...or another worker may have written a newer copy to disk
+        await load_disk_cache()
+        if time.monotonic() < _ORG_CACHE["expires"]:
+            return _ORG_CACHE["index"]
+        try:
+            await refresh_firm_index()
+        except HTTPException:
+            if _ORG_CACHE["index"] is None:
+                raise
+            _ORG_CACHE["expires"] = time.monotonic() + ORG_CACHE_RETRY
+        return _ORG_CACHE["index"]
+
+# ---------- shared (Redis) cache ----------
+# With REDIS_URL set, workers share one index in Redis instead of each holding
+# (and refreshing) its own copy. Rows are stored per index key as hash
+# fields, so a query reads just its bucket(s).
+_REDIS = redis_asyncio.from_url(REDIS_URL, decode_responses=True) if REDIS_URL else None
+_REDIS_KEY = "sra:orgs:v2"          # hash: outward code / full postcode -> JSON list of Firm rows
+_REDIS_META = "sra:orgs:v2:meta"    # hash: fetched_at / generation / etag / last_modified
+_REDIS_LOCK = "sra:orgs:v2:lock"    # SET NX: one worker refreshes at a time
+REDIS_LOCK_TTL = 120
+
+# Only touch the lock if it still holds our token; a plain GET then DEL/EXPIRE
+# could hit another worker's lock if ours expired in between.
+_RELEASE_LOCK = _REDIS.register_script("""
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+""") if _REDIS else None
+_EXTEND_LOCK = _REDIS.register_script("""
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("expire", KEYS[1], ARGV[2])
+end
+return 0
+""") if _REDIS else None
+
+async def publish_shared_index(index: Dict[str, List[Firm]]) -> None:
+    # Build under a scratch key and RENAME over the live one, so readers never
+    # see a half-written index and buckets that vanished upstream are dropped.
+    scratch = f"{_REDIS_KEY}:building"
+    async with _REDIS.pipeline(transaction=False) as pipe:
+        pipe.delete(scratch)
+        if index:
+            pipe.hset(scratch, mapping={
+                key: orjson.dumps([tuple(firm) for firm in rows])
+                for key, rows in index.items()
+            })
+            pipe.rename(scratch, _REDIS_KEY)
+        else:
+            pipe.delete(_REDIS_KEY)
+        await pipe.execute()
+
+async def refresh_shared_index() -> bool:
+    """
+    Refresh the shared index unless another worker already is.
+    Returns False straight away if the lock is taken, and True without fetching if
+    another worker published a fresh index just before we got the lock (so racing
+    warmups don't each re-download). After a failed refresh (upstream
+    or Redis) the lock is left to expire after ORG_CACHE_RETRY rather than
+    REDIS_LOCK_TTL, so workers back off together but not for long.
+    """
+    token = os.urandom(8).hex()
+    if not await _REDIS.set(_REDIS_LOCK, token, nx=True, ex=REDIS_LOCK_TTL):
+        return False
+    try:
+        meta = await _REDIS.hgetall(_REDIS_META)
+        index_exists = await _REDIS.exists(_REDIS_KEY)
+        if index_exists and time.time() - float(meta.get("fetched_at", 0)) < ORG_CACHE_TTL:
+            await _RELEASE_LOCK(keys=[_REDIS_LOCK], args=[token])
+            return True
+        if not index_exists:
+            # Index evicted (or never published) while meta survived: a 304 on
+            # the old validators would leave nothing to serve, so download in full
+            meta = {}
+        fresh = await download_firm_index(meta.get("etag"), meta.get("last_modified"))
+        now = str(time.time())
+        if fresh is not None:
+            index, etag, last_modified = fresh
+            await publish_shared_index(index)
+            meta = {"etag": etag or "", "last_modified": last_modified or "", "generation": now}
+        meta["fetched_at"] = now
+        async with _REDIS.pipeline(transaction=False) as pipe:
+            pipe.hset(_REDIS_META, mapping=meta)
+            # Past the TTL the data is only a fallback; drop it entirely after this
+            pipe.expire(_REDIS_META, STALE_INDEX_TTL)
+            pipe.expire(_REDIS_KEY, STALE_INDEX_TTL)
+            await pipe.execute()
+    except (HTTPException, RedisError):
+        await _EXTEND_LOCK(keys=[_REDIS_LOCK], args=[token, ORG_CACHE_RETRY])
+        raise
+    await _RELEASE_LOCK(keys=[_REDIS_LOCK], args=[token])
+    return True
+
+async def wait_for_shared_index() -> None:
+    """Block until some worker has published an index (refreshing it ourselves if we can)."""
+    deadline = time.monotonic() + REDIS_LOCK_TTL
+    while not await _REDIS.exists(_REDIS_KEY):
+        if await refresh_shared_index():
+            return
+        if time.monotonic() > deadline:
+            raise HTTPException(status_code=502, detail="Timed out waiting for the SRA index")
+        await asyncio.sleep(0.5)
+
+async def read_shared_index(full: str, outward: str) -> Optional[List[Firm]]:
+    """
+    Both buckets in one round trip; exact postcode wins if it has any firms.
+    None (not []) when the index hash itself is missing, e.g. evicted.
+    """
+    async with _REDIS.pipeline(transaction=True) as pipe:
+        pipe.exists(_REDIS_KEY)
+        pipe.hmget(_REDIS_KEY, full, outward)
+        exists, buckets = await pipe.execute()
+    if not exists:
+        return None
+    raw = next(filter(None, buckets), None)
+    return [Firm(*row) for row in orjson.loads(raw)] if raw else []
+
+async def warm_firm_index() -> None:
+    try:
+        if _REDIS is not None:
+            await refresh_shared_index()
+        else:
+            await get_firm_index()
+    except HTTPException:
+        pass  # the next request that needs the index will retry
+    except RedisError:
+        logger.exception("Background refresh of the shared SRA index failed")
+
+_WARMUP_TASK: Optional[asyncio.Task] = None
+
+def start_index_warmup() -> None:
+    global _WARMUP_TASK
+    if _WARMUP_TASK is None or _WARMUP_TASK.done():
+        _WARMUP_TASK = asyncio.create_task(warm_firm_index())
+
+# Just the fields firm_row / looks_active read
+_ORG_SELECT = "OrganisationID,OrganisationName,Email,GeneralEmail,Phone,AuthorisationStatus,Offices"
+# Set once SRA answers the filtered query with 400; it won't start accepting it
+# mid-process, so later cold-start requests go straight to the bulk index.
+_FILTER_REJECTED = False
+
+async def search_upstream(full: str, outward: str) -> List[Firm]:
+    """
+    Ask SRA (OData $filter) for only the firms with an office in this outward code,
+    so a query costs KBs rather than the full Organisations download.
+    startswith() also catches longer districts (SW1 -> SW1A, SW11), so the
+    rows go through index_orgs and we pick buckets exactly as the full index would.
+    """
+    global _FILTER_REJECTED
+    if _FILTER_REJECTED:
+        raise HTTPException(status_code=502, detail="SRA API does not support $filter")
+    query = urlencode(
+        {
+            "$filter": f"Offices/any(o: startswith(o/Address/PostCode, '{outward}'))",
+            "$select": _ORG_SELECT,
+        },
+        quote_via=quote,
+    )
+    resp = await fetch_sra(f"Organisations?{query}", final_statuses=(400,))
+    if resp.status_code == 400:
+        _FILTER_REJECTED = True
+        raise HTTPException(status_code=502, detail="SRA API does not support $filter")
+    data = orjson.loads(resp.content)
+    index: Dict[str, List[Firm]] = {}
+    index_orgs(index, data.get("value", []) or [])
+    return index.get(full) or index.get(outward, [])
+
+async def lookup_shared(full: str, outward: str) -> Tuple[List[Firm], Optional[str]]:
+    """
+    Redis-backed lookup. A stale shared index is served while one worker
+    refreshes it in the background; a cold (or evicted) one is handled as in
+    lookup_firms.
+    """
+    fetched_at, generation = await _REDIS.hmget(_REDIS_META, "fetched_at", "generation")
+    if fetched_at is not None:
+        if time.time() - float(fetched_at) >= ORG_CACHE_TTL:
+            start_index_warmup()
+        rows = await read_shared_index(full, outward)
+        if rows is not None:
+            return rows, generation
+    start_index_warmup()
+    try:
+        return await search_upstream(full, outward), None
+    except HTTPException:
+        await wait_for_shared_index()
+    rows = await read_shared_index(full, outward)
+    if rows is None:
+        raise HTTPException(status_code=502, detail="SRA index unavailable")
+    return rows, await _REDIS.hget(_REDIS_META, "generation")
+
+async def lookup_firms(full: str, outward: str) -> Tuple[List[Firm], Optional[str]]:
+    """
+    Return (rows, index generation) for a postcode: firms with an office at that
+    exact postcode if there are any, otherwise those in its outward code.
+    Serve from the index whenever we have one (fresh or stale). On a cold start,
+    answer this query with a filtered upstream call while the full index builds
+    in the background; if the filter is rejected, wait for the index instead.
+    Upstream-filtered answers carry no generation.
+    """
+    if _REDIS is not None:
+        try:
+            return await lookup_shared(full, outward)
+        except RedisError:
+            # Redis outage: answer from upstream rather than 500 (502 if that fails too)
+            logger.exception("Shared SRA index lookup failed; querying SRA directly")
+            return await search_upstream(full, outward), None
+    index = _ORG_CACHE["index"]
+    if index is None:
+        start_index_warmup()
+        try:
+            return await search_upstream(full, outward), None
+        except HTTPException:
+            index = await get_firm_index()
+    elif time.monotonic() >= _ORG_CACHE["expires"]:
+        # Stale: answer now, let one background task revalidate
+        start_index_warmup()
+    return index.get(full) or index.get(outward, []), _ORG_CACHE["generation"]
+
+@app.on_event("startup")
+async def prime_cache():
+    # Warm restarts start from the disk copy instead of a cold download
+    if _DISK_CACHE is not None:
+        await load_disk_cache()
+
+@app.on_event("shutdown")
+async def close_caches():
+    if _DISK_CACHE is not None:
+        _DISK_CACHE.close()
+    if _REDIS is not None:
+        await _REDIS.aclose()
+
 # ---------- endpoints ----------
 @app.get("/", summary="Root")
-def root():
+async def root():
     return {"ok": True, "msg": "FastAPI is alive."}
 
 @app.get("/health", summary="Health")
-def health():
+async def health():
     return {"status": "ok"}
 
 @app.get("/probe", summary="Probe SRA hosts")
-def probe():
+async def probe():
     """
     Quick diagnostic: attempts a lightweight call to each SRA host
     and reports whether it succeeds or the error we get.
+    Hosts are probed concurrently, so the worst case is one timeout, not one per host.
     """
+    urls = [f"{base.rstrip('/')}/Organisations?$top=1" for base in SRA_HOSTS]
+    responses = await asyncio.gather(
+        *(client.get(url, timeout=10) for url in urls), return_exceptions=True
+    )
     results = []
-    for base in SRA_HOSTS:
-        url = f"{base.rstrip('/')}/Organisations?$top=1"
-        try:
-            r = requests.get(url, headers=HEADERS, timeout=10)
-            ok = r.ok
-            status = r.status_code
-            body = (r.text or "")[:300]
-            results.append({"host": base, "ok": ok, "status": status, "sample": body})
-        except Exception as e:
-            results.append({"host": base, "ok": False, "error": str(e)})
+    for base, r in zip(SRA_HOSTS, responses):
+        if isinstance(r, Exception):
+            results.append({"host": base, "ok": False, "error": str(r)})
+            continue
+        ok = r.is_success
+        status = r.status_code
+        body = (r.text or "")[:300]
+        results.append({"host": base, "ok": ok, "status": status, "sample": body})
     return {"probe": results}
 
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """If-None-Match check using weak comparison (RFC 9110): W/ prefixes are ignored."""
+    opaque = etag.removeprefix("W/")
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*" or tag.removeprefix("W/") == opaque:
+            return True
+    return False
+
 @app.get(
     "/search",
     summary="Find SRA-registered firms by postcode",
-    description="Returns firms with an office whose outward postcode matches the supplied UK postcode.",
+    description=(
+        "Returns firms with an office at the supplied UK postcode; if there are none, "
+        "firms with an office whose outward postcode matches."
+    ),
 )
-def search_firms(
-    postcode: str = Query(..., description="UK postcode, e.g., SW1A 1AA or SW1A1AA")
+async def search_firms(
+    request: Request,
+    postcode: str = Query(..., description="UK postcode, e.g., SW1A 1AA or SW1A1AA"),
 ):
+    # Checked before normalise_postcode so junk input never lands in its lru_cache
+    if len(postcode) > MAX_POSTCODE_INPUT:
+        raise HTTPException(status_code=422, detail="Please provide a valid UK postcode.")
     pc_clean = normalise_postcode(postcode)
-    if not UK_PC_RE.match(pc_clean):
+    if not (plausible_postcode(pc_clean) and UK_PC_RE.match(pc_clean)):
         raise HTTPException(status_code=422, detail="Please provide a valid UK postcode.")
 
-    # Pull organisations (the payload includes Offices)
-    data = call_sra_json("Organisations")
-
-    # Filter for active orgs with at least one matching office outward code
-    results: List[Dict[str, Any]] = []
-    for org in data.get("value", []) or []:
-        if not looks_active(org):
-            continue
-        for office in org.get("Offices", []) or []:
-            if office_matches_postcode(office, pc_clean):
-                addrs = office.get("Address", {}) or {}
-                results.append(
-                    {
-                        "OrganisationID": org.get("OrganisationID"),
-                        "Name": org.get("OrganisationName"),
-                        "Email": org.get("Email") or org.get("GeneralEmail"),
-                        "Phone": org.get("Phone"),
-                        "Postcode": addrs.get("PostCode"),
-                        "Address1": addrs.get("Address1"),
-                        "Town": addrs.get("Town"),
-                        "AuthorisationStatus": org.get("AuthorisationStatus"),
-                    }
-                )
-                break  # one matching office is enough
-    return {"count": len(results), "results": results}
+    full = full_postcode(pc_clean)
+    results, generation = await lookup_firms(full, outward_code(pc_clean))
+    headers = {"Cache-Control": SEARCH_CACHE_CONTROL}
+    if generation:
+        # Same postcode + same index => same body, so the ETag needs no body hash.
+        # Weak, because GZipMiddleware may re-encode the body.
+        digest = hashlib.sha1(f"{full}:{generation}".encode()).hexdigest()
+        headers["ETag"] = f'W/"{digest}"'
+        if etag_matches(request.headers.get("if-none-match", ""), headers["ETag"]):
+            return Response(status_code=304, headers=headers)
+    return ORJSONResponse(
+        {"count": len(results), "results": [firm._asdict() for firm in results]},
+        headers=headers,
+    )